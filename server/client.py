@@ -3,12 +3,33 @@
 #
 import logging
 import queue
+import re
 import socket
+import time
 from curses import ascii
 from enum import Enum
 from msgs import CserverCmd
 from threading import Thread
 
+# Line terminators of incoming client messages. Only these end a line,
+# other whitespace such as form feed is part of the message.
+_eol_re = re.compile('\r\n|\r|\n')
+
+# Chat messages are only batched when at least this many are expected
+# to arrive within the batch window, so quiet rooms keep immediate
+# delivery.
+_BATCH_MIN_MSGS = 2
+
+# The number of chat messages a batch is sized to collect at the
+# estimated message rate. The batch is held for the time this many
+# messages are expected to take, up to the /batch window, so the
+# batching delay shrinks as the rate grows.
+_BATCH_TARGET_MSGS = 8
+
+# Weight of the newest inter-arrival time in the moving average used
+# to estimate the chat message rate.
+_RATE_ALPHA = 0.1
+
 class CserverClientState(Enum):
     """The state of a chat client."""
     NEW = 1,
@@ -53,6 +74,29 @@ class CserverClient:
     to the chat client. This thread forwards received messages to the
     main server thread using _inbound_queue
 
+    _batch_window (float): the maximum time, in seconds, a chat
+    message is held to be batched with others, or 0 if batching is
+    disabled. The time actually used adapts to the message rate.
+
+    _batch_size (int): the maximum number of chat messages in a batch
+
+    _batch (list of (str, float)): the pending batch of formatted chat
+    messages, each with the time it was batched
+
+    _batch_deadline (float): the time.monotonic() value at which the
+    pending batch must be sent
+
+    _msg_interval (float): moving average of the time, in seconds,
+    between chat messages, or None until two chat messages have been
+    seen
+
+    _last_msg_time (float): the time.monotonic() value of the most
+    recent chat message, or None if there has been no chat message
+
+    _stats (list of int, int, float): the number of chat messages
+    sent, the number of writes used to send them and their total
+    batching delay in seconds
+
     """
     def __init__(self, csocket, inbound_queue):
         '''Create an object to manage interaction with a client.
@@ -73,6 +117,13 @@ class CserverClient:
         self._recv_str = ''
         self.outbound_queue = queue.Queue()
         self._inbound_queue = inbound_queue
+        self._batch_window = 0
+        self._batch_size = 1
+        self._batch = []
+        self._batch_deadline = None
+        self._msg_interval = None
+        self._last_msg_time = None
+        self._stats = [0, 0, 0.0]
         self._outbound_thread = Thread(target=CserverClient.outbound_handler, args=(self, ))
         self._inbound_thread = Thread(target=CserverClient.inbound_handler, args=(self,))
         self._outbound_thread.start()
@@ -82,11 +133,22 @@ class CserverClient:
         """Handle all outgoing client traffic."""
         logging.info("starting client outbound_handler of socket {0}".format(self._csocket.getpeername()))
 
+        closed = False
         try:
             while (True):
                 # Queue contains tuples with the first element
                 # indicating the kind. Use that to do the right thing.
-                cmd = self.outbound_queue.get()
+                # While a batch is pending wait no longer than its
+                # deadline.
+                timeout = None
+                if self._batch:
+                    timeout = max(0, self._batch_deadline - time.monotonic())
+                try:
+                    cmd = self.outbound_queue.get(timeout=timeout)
+                except queue.Empty:
+                    if not self._flush_batch():
+                        return
+                    continue
                 logging.debug("outbound command {0}".format(cmd))
                 try:
                     msg = None
@@ -99,13 +161,59 @@ class CserverClient:
                     elif cmd[0] is CserverCmd.INVALID_USERNAME:
                         msg = ("Sorry, name must contain only letters, numbers and underscore.",)
                     elif cmd[0] is CserverCmd.WELCOME_USER:
-                        name = cmd[1]
-                        msg = ("Welcome {0}!".format(name),)
+                        name, token = (cmd[1], cmd[2])
+                        msg = ["Welcome {0}!".format(name),]
+                        if token is not None:
+                            msg.append("* resume token: {0}".format(token))
                         self.state = CserverClientState.LOGGED_IN
                         self.username = name
+                    elif cmd[0] is CserverCmd.RESUME_USER:
+                        name, room, room_users, targets, dropped = (cmd[1], cmd[2], cmd[3], cmd[4], cmd[5])
+                        msg = ["Welcome back {0}!".format(name),]
+                        self.state = CserverClientState.LOGGED_IN
+                        self.username = name
+                        self.targets = targets
+                        if room is not None:
+                            msg.append("Resuming room: {0}".format(room))
+                            for un in room_users:
+                                if un == self.username:
+                                    msg.append("* {0} (** this is you)".format(un))
+                                else:
+                                    msg.append("* {0}".format(un))
+                            msg.append("End of list.")
+                            self.state = CserverClientState.IN_ROOM
+                            self.roomname = room
+                        if targets is not None:
+                            msg.append("* you are now chatting privately: {0}".format(" ".join(targets)))
+                        if dropped > 0:
+                            msg.append("* {0} missed messages were dropped".format(dropped))
+                    elif cmd[0] is CserverCmd.INVALID_RESUME:
+                        msg = ("Sorry, that resume token is not valid.",)
+                    elif cmd[0] is CserverCmd.SESSION_RESUMED_ELSEWHERE:
+                        msg = ("* your session was resumed from another connection",
+                               "BYE")
                     elif cmd[0] is CserverCmd.MSG:
                         user, cmsg = (cmd[1], cmd[2])
-                        msg = ("{0}: {1}".format(user, cmsg),)
+                        line = "{0}: {1}\n".format(user, cmsg)
+                        if self._batch_message(line):
+                            if len(self._batch) >= self._batch_size and not self._flush_batch():
+                                return
+                        else:
+                            msg = ("{0}: {1}".format(user, cmsg),)
+                            self._stats[0] += 1
+                            self._stats[1] += 1
+                    elif cmd[0] is CserverCmd.BATCH:
+                        window, size = (cmd[1], cmd[2])
+                        if window > 0:
+                            msg = ("* message batching on: up to {0} ms".format(window),)
+                        else:
+                            msg = ("* message batching off",)
+                        self._batch_window = window / 1000
+                        self._batch_size = size
+                    elif cmd[0] is CserverCmd.BATCH_STATUS:
+                        msg = (self._batch_status(),)
+                    elif cmd[0] is CserverCmd.INVALID_BATCH:
+                        msg = ("Sorry, batch window must be a number of milliseconds from 0 to {0}, or off.".format(cmd[1]),)
                     elif cmd[0] is CserverCmd.PRIVATE:
                         targets = cmd[1]
                         msg = ("* you are now chatting privately: {0}".format(" ".join(targets)),)
@@ -163,12 +271,20 @@ class CserverClient:
                     elif cmd[0] is CserverCmd.INVALID_CMD:
                         msg = ("Sorry, you have entered an unknown command",)
 
+                    # Send any pending batch first so chat messages
+                    # stay ordered with everything else and are not
+                    # lost when the server closes the client.
+                    if ((msg is not None or cmd[0] is CserverCmd.CLOSE) and
+                        self._batch and not self._flush_batch()):
+                        return
+
                     if msg is not None:
                         for m in msg:
                             if not self._send(str(m + '\n')):
                                 return
 
-                    if cmd[0] is CserverCmd.QUIT:
+                    if cmd[0] is CserverCmd.QUIT or cmd[0] is CserverCmd.CLOSE:
+                        closed = True
                         self.username = None
                         self.roomname = None
                         return
@@ -176,9 +292,19 @@ class CserverClient:
                     self.outbound_queue.task_done()
                 
         finally:
-            logging.info("exiting outbound_handler thread")
-            self._inbound_queue.put((CserverCmd.MSG, self, "/quit"))
-            self._csocket.shutdown(socket.SHUT_RDWR)
+            msgs, writes, delay = self._stats
+            logging.info("exiting outbound_handler thread, sent {0} chat messages in {1} writes "
+                         "with {2:.1f} ms average batching delay".format(
+                             msgs, writes, delay * 1000 / msgs if msgs > 0 else 0))
+            # If the server didn't direct this client to exit then
+            # the connection was lost, let the server decide whether
+            # to hold the session for resume.
+            if not closed:
+                self._inbound_queue.put((CserverCmd.DISCONNECT, self))
+            try:
+                self._csocket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             self._csocket.close()
 
     def inbound_handler(self):
@@ -197,6 +323,70 @@ class CserverClient:
                 logging.error("unexpected inbound_handler termination: {0}".format(ex))
         finally:
             logging.info("exiting inbound_handler thread")
+            self._inbound_queue.put((CserverCmd.DISCONNECT, self))
+
+    def _batch_message(self, line):
+        """Add a formatted chat message to the pending batch if batching is
+        enabled and the estimated message rate is high enough for the
+        batch to hold more than one message. A new batch is held for
+        the time _BATCH_TARGET_MSGS messages are expected to take at
+        the estimated rate, but no longer than the batch window.
+
+        Args:
+
+        line (str): the formatted chat message
+
+        Return True if the message was batched, False if it should be
+        sent immediately
+
+        """
+        now = time.monotonic()
+        if self._last_msg_time is not None:
+            interval = now - self._last_msg_time
+            if self._msg_interval is None:
+                self._msg_interval = interval
+            else:
+                self._msg_interval += _RATE_ALPHA * (interval - self._msg_interval)
+        self._last_msg_time = now
+
+        if not self._batch:
+            if (self._batch_window <= 0 or self._msg_interval is None or
+                self._msg_interval * _BATCH_MIN_MSGS > self._batch_window):
+                return False
+            self._batch_deadline = now + min(self._batch_window,
+                                             _BATCH_TARGET_MSGS * self._msg_interval)
+        self._batch.append((line, now))
+        return True
+
+    def _flush_batch(self):
+        """Send the pending batch of chat messages in a single write.
+
+        Return True if batch sent successfully, False if failure
+
+        """
+        if not self._batch:
+            return True
+        now = time.monotonic()
+        self._stats[0] += len(self._batch)
+        self._stats[1] += 1
+        self._stats[2] += sum(now - t for _, t in self._batch)
+        bmsg = ''.join(line for line, _ in self._batch)
+        self._batch = []
+        self._batch_deadline = None
+        return self._send(bmsg)
+
+    def _batch_status(self):
+        """Return a description of the batching mode and the chat message
+        delivery statistics of the client.
+
+        """
+        msgs, writes, delay = self._stats
+        if self._batch_window > 0:
+            mode = "on ({0:g} ms)".format(self._batch_window * 1000)
+        else:
+            mode = "off"
+        return "* message batching {0}: {1} messages in {2} writes, average delay {3:.1f} ms".format(
+            mode, msgs, writes, delay * 1000 / msgs if msgs > 0 else 0)
 
     def _send(self, msg):
         """Send a message to the client.
@@ -230,6 +420,13 @@ class CserverClient:
         RECV_SIZE = 1024
         try:
             while (True):
+                # Return a complete line already received before
+                # waiting for more, a busy client can send many lines
+                # in a single recv
+                parts = _eol_re.split(self._recv_str, 1)
+                if len(parts) == 2:
+                    self._recv_str = parts[1]
+                    return parts[0]
                 m = self._csocket.recv(RECV_SIZE)
                 if not m:
                     logging.error('failed to recv message, client disconnected')
@@ -238,12 +435,7 @@ class CserverClient:
                 # control characters
                 m = bytes([ b if ascii.isgraph(b) or ascii.isspace(b) else 0xff for b in m ])
                 self._recv_str = self._recv_str + m.decode('utf-8', 'ignore')
-                if self._recv_str.find('\n') >= 0 or self._recv_str.find('\r') >= 0:
-                    lines = self._recv_str.splitlines()
-                    self._recv_str = '\n'.join(lines[1:])
-                    return lines[0]
         except Exception as ex:
-            logging.error('failed to recv message to client {0}: {1}'.format(self._csocket.getpeername(), ex))
-            return False
-        return True
+            logging.error('failed to recv message from client: {0}'.format(ex))
+            return None
 
@@ -41,6 +41,17 @@
 #   rooms across server invocations but is extensible to handle future
 #   possible features such are persistent user name, passwords, room
 #   properties, etc.
+# - Session resume. Each user is issued a resume token at login. When
+#   a connection drops the user's name, room, /private targets and a
+#   bounded buffer of missed chat messages are held for a grace
+#   period. Entering /resume <token> at the login prompt restores the
+#   session without any leave/join broadcasts to the room.
+# - /batch <ms> command to batch incoming chat messages arriving within
+#   a window of up to <ms> milliseconds into a single write. Batching
+#   adapts to the message rate: quiet rooms keep immediate delivery
+#   and the window shrinks as the rate grows. /batch off disables
+#   batching and /batch alone reports the message count, write count
+#   and average batching delay.
 #
 # All minimum and additional features have appropriate error checking
 # and reporting.
@@ -53,16 +64,21 @@ import re
 import shelve
 import socket
 import sys
+import time
 from threading import Thread
 from msgs import CserverCmd
 from msgs import CserverMsgKind
 from oparse import CserverOptionParser
 from client import CserverClient
 from client import CserverClientState
+from session import CserverSession
 
 _username_re = re.compile('\w*$')
 _roomname_re = re.compile('\w*$')
 
+# Maximum /batch window in milliseconds
+_MAX_BATCH_WINDOW = 1000
+
 def main(argv=None):
     """The main entry point for the chat server.
 
@@ -89,6 +105,12 @@ def main(argv=None):
     # name of the user (username -> CserverClient).
     user_clients = { }
 
+    # Sessions of all logged in users, both connected and suspended,
+    # indexed by the name of the user (username -> CserverSession),
+    # and the resume tokens of those sessions (token -> username).
+    sessions = { }
+    session_tokens = { }
+
     # A single queue is used by all clients to communicate inbound
     # activity
     inbound_queue = queue.Queue()
@@ -100,6 +122,13 @@ def main(argv=None):
     conn_thread.daemon = True
     conn_thread.start()
 
+    # Spawn a thread to periodically expire the suspended sessions
+    # whose grace period has ended.
+    if args.resume_grace > 0:
+        reaper_thread = Thread(target=_session_reaper, args=(inbound_queue,))
+        reaper_thread.daemon = True
+        reaper_thread.start()
+
     # Main control loop... wait for new connections or other client
     # requests and handle them
     with shelve.open(args.config, writeback=True) as db:
@@ -130,7 +159,34 @@ def main(argv=None):
                         # appropriate CserverClient instance.
                         if client.state is CserverClientState.NEW:
                             username = cmd[2]
-                            if username in user_clients:
+                            msg_kind, msg_payload = msgs.decode_msg(username)
+                            # /resume, take over a suspended session
+                            # or a session whose old connection hasn't
+                            # been seen to drop yet
+                            if msg_kind is CserverMsgKind.RESUME_CMD:
+                                username = session_tokens.get(msg_payload)
+                                if username is None:
+                                    client.outbound_queue.put((CserverCmd.INVALID_RESUME,))
+                                    client.outbound_queue.put((CserverCmd.LOGIN,))
+                                else:
+                                    session = sessions[username]
+                                    if username in user_clients:
+                                        old_client = user_clients.pop(username)
+                                        session.suspend(_get_user_room(room_users, username),
+                                                        old_client.targets, args.resume_grace)
+                                        old_client.outbound_queue.put((CserverCmd.SESSION_RESUMED_ELSEWHERE,))
+                                        old_client.outbound_queue.put((CserverCmd.CLOSE,))
+                                    missed = session.resume()
+                                    user_clients[username] = client
+                                    room = session.roomname
+                                    client.outbound_queue.put((CserverCmd.RESUME_USER, username, room,
+                                                               sorted(room_users[room]) if room is not None else None,
+                                                               session.targets, session.dropped))
+                                    if session.batch_window > 0:
+                                        client.outbound_queue.put((CserverCmd.BATCH, session.batch_window, args.batch_size))
+                                    for m in missed:
+                                        client.outbound_queue.put(m)
+                            elif username in user_clients or username in sessions:
                                 client.outbound_queue.put((CserverCmd.EXISTING_USER,))
                                 client.outbound_queue.put((CserverCmd.LOGIN,))
                             elif not _username_re.match(username):
@@ -138,7 +194,18 @@ def main(argv=None):
                                 client.outbound_queue.put((CserverCmd.LOGIN,))
                             else:
                                 user_clients[username] = client
-                                client.outbound_queue.put((CserverCmd.WELCOME_USER, username))
+                                token = None
+                                if args.resume_grace > 0:
+                                    session = CserverSession(username, args.resume_buffer)
+                                    sessions[username] = session
+                                    session_tokens[session.token] = username
+                                    token = session.token
+                                client.outbound_queue.put((CserverCmd.WELCOME_USER, username, token))
+                        elif user_clients.get(client.username) is not client:
+                            # The client was closed or its session
+                            # taken over by a resume, ignore anything
+                            # still arriving from it.
+                            logging.debug("ignoring message from detached client")
                         else:
                             # User is already logged in so decode the
                             # message... it will either be a command
@@ -225,6 +292,7 @@ def main(argv=None):
                                             cc.outbound_queue.put((CserverCmd.SEE_LEAVE_ROOM, client.username, client.roomname))
                                 if client.username in user_clients:
                                     del user_clients[client.username]
+                                    _end_session(sessions, session_tokens, client.username)
                                 client.outbound_queue.put((CserverCmd.QUIT,))
                             # chat message
                             elif msg_kind is CserverMsgKind.ALL_CHAT:
@@ -233,16 +301,65 @@ def main(argv=None):
                                 else:
                                     if client.targets is None:
                                         target_clients = user_clients.values()
+                                        target_sessions = sessions.values()
                                     else:
-                                        target_clients = [ user_clients[t] for t in client.targets ]
+                                        target_clients = [ user_clients[t] for t in client.targets if t in user_clients ]
                                         target_clients.append(client)
+                                        target_sessions = [ sessions[t] for t in client.targets if t in sessions ]
                                     for cc in target_clients:
                                         if cc.state is CserverClientState.IN_ROOM and cc.roomname == client.roomname:
                                             cc.outbound_queue.put((CserverCmd.MSG, client.username, msg_payload))
+                                    # hold the message for suspended users in the room
+                                    for ss in target_sessions:
+                                        if ss.suspended() and ss.roomname == client.roomname:
+                                            ss.buffer((CserverCmd.MSG, client.username, msg_payload))
+                            # /batch
+                            elif msg_kind is CserverMsgKind.BATCH_CMD:
+                                if msg_payload == '':
+                                    client.outbound_queue.put((CserverCmd.BATCH_STATUS,))
+                                else:
+                                    window = _parse_batch_window(msg_payload)
+                                    if window is None:
+                                        client.outbound_queue.put((CserverCmd.INVALID_BATCH, _MAX_BATCH_WINDOW))
+                                    else:
+                                        if client.username in sessions:
+                                            sessions[client.username].batch_window = window
+                                        client.outbound_queue.put((CserverCmd.BATCH, window, args.batch_size))
+                            # /resume is only valid at login
+                            elif msg_kind is CserverMsgKind.RESUME_CMD:
+                                client.outbound_queue.put((CserverCmd.INVALID_CMD,))
                             # unknown command...
                             elif msg_kind is CserverMsgKind.UNKNOWN_CMD:
                                 client.outbound_queue.put((CserverCmd.INVALID_CMD,))
                                 
+                    elif cmd[0] is CserverCmd.DISCONNECT:
+                        client = cmd[1]
+                        # Both client threads report a lost connection
+                        # and the client may already have quit or been
+                        # taken over by a resume, so only handle the
+                        # disconnect of a current user.
+                        username = _get_client_username(user_clients, client)
+                        if username is None:
+                            client.outbound_queue.put((CserverCmd.CLOSE,))
+                        elif username not in sessions:
+                            inbound_queue.put((CserverCmd.MSG, client, "/quit"))
+                        else:
+                            # Hold the session without leaving the
+                            # room, the user remains visible in the
+                            # room until the session expires.
+                            del user_clients[username]
+                            sessions[username].suspend(_get_user_room(room_users, username),
+                                                       client.targets, args.resume_grace)
+                            client.outbound_queue.put((CserverCmd.CLOSE,))
+                    elif cmd[0] is CserverCmd.EXPIRE_SESSIONS:
+                        now = time.monotonic()
+                        for ss in [ ss for ss in sessions.values() if ss.expired(now) ]:
+                            _end_session(sessions, session_tokens, ss.username)
+                            if ss.roomname is not None:
+                                room_users[ss.roomname].discard(ss.username)
+                                for cc in user_clients.values():
+                                    if cc.state is CserverClientState.IN_ROOM and cc.roomname == ss.roomname:
+                                        cc.outbound_queue.put((CserverCmd.SEE_LEAVE_ROOM, ss.username, ss.roomname))
                     else:
                         logger.error("unexpected command: {0}".format(cmd))
                 finally:
@@ -275,6 +392,92 @@ def _get_room_list(room_users):
         rlist.append((r, sorted(room_users[r])))
     return rlist
 
+def _parse_batch_window(arg):
+    """Return the /batch window in milliseconds given by a /batch
+    argument, 0 for 'off', or None if the argument is not valid.
+
+    Args:
+
+    arg (str): the /batch argument
+
+    """
+    if arg == 'off':
+        return 0
+    try:
+        window = int(arg)
+    except ValueError:
+        return None
+    if window < 0 or window > _MAX_BATCH_WINDOW:
+        return None
+    return window
+
+def _get_user_room(room_users, username):
+    """Return the name of the room a user is in, or None if the user is
+    not in a room.
+
+    Args:
+
+    room_users (map room -> set of users names): the users currently
+    in each room
+
+    username (str): the name of the user
+
+    """
+    for r, ru in room_users.items():
+        if username in ru:
+            return r
+    return None
+
+def _get_client_username(user_clients, client):
+    """Return the name of the user represented by a client, or None if
+    the client doesn't represent a logged in user.
+
+    Args:
+
+    user_clients (map username -> CserverClient): the clients of all
+    logged in users
+
+    client (CserverClient): the client
+
+    """
+    for un, cc in user_clients.items():
+        if cc is client:
+            return un
+    return None
+
+def _end_session(sessions, session_tokens, username):
+    """End the session of a user, if any, revoking its resume token.
+
+    Args:
+
+    sessions (map username -> CserverSession): the sessions of all
+    logged in users
+
+    session_tokens (map token -> username): the resume tokens of all
+    sessions
+
+    username (str): the name of the user
+
+    """
+    session = sessions.pop(username, None)
+    if session is not None:
+        del session_tokens[session.token]
+
+def _session_reaper(cmd_queue):
+    """Handler that periodically directs the server thread to expire
+    suspended sessions.
+
+    Args:
+
+    cmd_queue (queue.Queue): the queue to use to communicate to the
+    server thread
+
+    """
+    REAP_INTERVAL = 1.0
+    while (True):
+        time.sleep(REAP_INTERVAL)
+        cmd_queue.put((CserverCmd.EXPIRE_SESSIONS,))
+
 def _connection_handler(args, cmd_queue):
     """Handler for new client connections. For each new connection to the
     chat server a CserverClient instance is create to handle the
@@ -33,7 +33,16 @@ class CserverCmd(Enum):
     PUBLIC = 20,
     INVALID_PRIVATE = 21,
     INVALID_CMD = 22,
-    QUIT = 23
+    QUIT = 23,
+    DISCONNECT = 24,
+    CLOSE = 25,
+    EXPIRE_SESSIONS = 26,
+    RESUME_USER = 27,
+    INVALID_RESUME = 28,
+    BATCH = 29,
+    BATCH_STATUS = 30,
+    INVALID_BATCH = 31,
+    SESSION_RESUMED_ELSEWHERE = 32
 
 class CserverMsgKind(Enum):
     """Types of messages delivered by a CserverClient to the server. Each
@@ -49,7 +58,9 @@ class CserverMsgKind(Enum):
     JOIN_CMD = 5,
     LEAVE_CMD = 6,
     QUIT_CMD = 7,
-    UNKNOWN_CMD = 8
+    UNKNOWN_CMD = 8,
+    RESUME_CMD = 9,
+    BATCH_CMD = 10
 
 def decode_msg(msg):
     """Return the CserverMsgKind value and payload corresponding to a chat
@@ -80,6 +91,12 @@ def decode_msg(msg):
         return (CserverMsgKind.PRIVATE_CMD, payload.strip().split())
     elif msg.startswith('/public'):
         return (CserverMsgKind.PUBLIC_CMD, None)
+    elif msg.startswith('/resume'):
+        payload = msg[len('/resume'):]
+        return (CserverMsgKind.RESUME_CMD, payload.strip())
+    elif msg.startswith('/batch'):
+        payload = msg[len('/batch'):]
+        return (CserverMsgKind.BATCH_CMD, payload.strip())
     elif msg.startswith('/'):
         return (CserverMsgKind.UNKNOWN_CMD, None)
 
@@ -4,6 +4,21 @@
 import argparse
 import logging
 
+def _non_negative(kind):
+    """Return an argparse type converting an argument to 'kind' (int or
+    float) and rejecting values less than 0.
+
+    """
+    def convert(arg):
+        try:
+            value = kind(arg)
+        except ValueError:
+            raise argparse.ArgumentTypeError('invalid {0} value: {1!r}'.format(kind.__name__, arg))
+        if value < 0:
+            raise argparse.ArgumentTypeError('must not be negative: {0!r}'.format(arg))
+        return value
+    return convert
+
 class CserverOptionParser:
     """Command-line parser for the char server."""
 
@@ -17,6 +32,15 @@ class CserverOptionParser:
                                   help='Server port (default 19567)')
         self._parser.add_argument('--banner', default='Welcome to the XYZ chat server', 
                                   help='Banner to show to clients when they connect')
+        self._parser.add_argument('--resume-grace', type=_non_negative(float), default=30.0,
+                                  help='Seconds to hold the session of a disconnected user '
+                                  'for resume, 0 to disable (default 30)')
+        self._parser.add_argument('--resume-buffer', type=_non_negative(int), default=100,
+                                  help='Maximum number of missed messages held for a '
+                                  'disconnected user (default 100)')
+        self._parser.add_argument('--batch-size', type=int, default=64,
+                                  help='Maximum number of chat messages sent in a single '
+                                  'write to a client using /batch (default 64)')
         self._parser.add_argument('config', 
                                   help='Filename for server configuration. Will be created if '
                                   'does not exist')
@@ -0,0 +1,111 @@
+#
+# Copyright 2015 David Goodwin. All rights reserved.
+#
+import collections
+import secrets
+import time
+
+class CserverSession:
+    """The resumable session of a logged in chat user. A session is
+    created when the user logs in and lives until the user quits or
+    until the session has been suspended for longer than the grace
+    period. While suspended the session holds the state needed to
+    restore the user without any leave/join traffic.
+
+    Attributes:
+
+    username (str): the name of the user owning the session
+
+    token (str): the resume token issued to the user at login
+
+    roomname (str): the room the user was in when the session was
+    suspended, or None if not in a room
+
+    targets (list of str): the /private targets in effect when the
+    session was suspended, or None if chatting publicly
+
+    expires (float): the time.monotonic() value at which a suspended
+    session expires, or None if the session is not suspended
+
+    dropped (int): the number of missed messages that did not fit
+    in the missed message buffer
+
+    batch_window (int): the /batch window of the user in
+    milliseconds, restored on resume, or 0 if not batching
+
+    _missed (collections.deque): bounded buffer of the CserverCmd.MSG
+    commands that were directed to the user while suspended
+
+    """
+    def __init__(self, username, buffer_size):
+        '''Create a session for a user.
+
+        Args:
+
+        username (str): the name of the user
+
+        buffer_size (int): the maximum number of missed messages
+        held while the session is suspended
+
+        '''
+        self.username = username
+        self.token = secrets.token_urlsafe(16)
+        self.roomname = None
+        self.targets = None
+        self.expires = None
+        self.dropped = 0
+        self.batch_window = 0
+        self._missed = collections.deque(maxlen=buffer_size)
+
+    def suspended(self):
+        """Return True if the session is suspended."""
+        return self.expires is not None
+
+    def expired(self, now):
+        """Return True if the session is suspended and its grace period
+        ended before 'now' (a time.monotonic() value).
+
+        """
+        return self.expires is not None and self.expires <= now
+
+    def suspend(self, roomname, targets, grace):
+        """Suspend the session.
+
+        Args:
+
+        roomname (str): the room the user is in, or None
+
+        targets (list of str): the /private targets of the user, or None
+
+        grace (float): the number of seconds to hold the session
+
+        """
+        self.roomname = roomname
+        self.targets = targets
+        self.expires = time.monotonic() + grace
+        self.dropped = 0
+        self._missed.clear()
+
+    def buffer(self, cmd):
+        """Record a command missed while suspended. When the buffer is full
+        the oldest missed command is discarded.
+
+        Args:
+
+        cmd (tuple): the CserverCmd.MSG command that was missed
+
+        """
+        if len(self._missed) == self._missed.maxlen:
+            self.dropped += 1
+        self._missed.append(cmd)
+
+    def resume(self):
+        """Resume the session.
+
+        Return the list of missed commands, oldest first.
+
+        """
+        missed = list(self._missed)
+        self._missed.clear()
+        self.expires = None
+        return missed